@@ -68,9 +68,9 @@ namespace MusicBeePlugin
             if (!trackLoopPoints.ContainsKey(selectedFile))
             {
                 mbApiInterface.MB_SetBackgroundTaskMessage("OST Extender: Analyzing track...");
-                string result = RunPythonScript(selectedFile);
+                bool succeeded = RunPythonScript(selectedFile, out string result);
                 mbApiInterface.MB_SetBackgroundTaskMessage("");
-                if (string.IsNullOrEmpty(result) || !result.Contains(":"))
+                if (!succeeded || string.IsNullOrEmpty(result) || !result.Contains(":"))
                 {
                     MessageBox.Show($"Could not find loop points.\n\nDetails: {result}", "Analysis Failed", MessageBoxButtons.OK, MessageBoxIcon.Warning);
                     return;
@@ -195,12 +195,18 @@ namespace MusicBeePlugin
 
 
         
-        private string RunPythonScript(string inputFile)
+        // Returns true when the analyzer succeeded; output is then its "start:end" result,
+        // otherwise the error the analyzer wrote to stderr
+        private bool RunPythonScript(string inputFile, out string output)
         {
             string pythonExePath = "python.exe";
             string pluginDirectory = Path.GetDirectoryName(this.GetType().Assembly.Location);
             string scriptPath = Path.Combine(pluginDirectory, "looper.py");
-            if (!File.Exists(scriptPath)) return "Error: looper.py not found in Plugins directory.";
+            if (!File.Exists(scriptPath))
+            {
+                output = "looper.py not found in Plugins directory.";
+                return false;
+            }
             var startInfo = new ProcessStartInfo {
                 FileName = pythonExePath, Arguments = $"\"{scriptPath}\" \"{inputFile}\"",
                 UseShellExecute = false, RedirectStandardOutput = true, RedirectStandardError = true, CreateNoWindow = true
@@ -208,15 +214,24 @@ namespace MusicBeePlugin
             try {
                 using (var process = Process.Start(startInfo))
                 {
+                    // Drain stderr in the background so library warnings can't fill the pipe and block the analyzer
+                    var errTask = process.StandardError.ReadToEndAsync();
                     string result = process.StandardOutput.ReadToEnd();
-                    string err = process.StandardError.ReadToEnd();
+                    string err = errTask.Result;
                     process.WaitForExit();
-                    return process.ExitCode == 0 ? result.Trim() : err;
+                    if (process.ExitCode == 0)
+                    {
+                        output = result.Trim();
+                        return true;
+                    }
+                    output = string.IsNullOrWhiteSpace(err) ? $"Analyzer exited with code {process.ExitCode}." : err.Trim();
+                    return false;
                 }
             }
             catch (Exception ex)
             {
-                return $"Failed to launch Python. Is it in your system PATH?\n\nDetails: {ex.Message}";
+                output = $"Failed to launch Python. Is it in your system PATH?\n\nDetails: {ex.Message}";
+                return false;
             }
         }
 
@@ -1,60 +1,173 @@
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from threadpoolctl import threadpool_limits
+import joblib
 import librosa
 import numpy as np
+import soundfile as sf
 import sys
 import os
 
-def find_loop_points(y, sr, min_duration=5.0):
-    """Find loop points and return start:end format"""
+# Largest size the feature cache may grow to before old entries are evicted
+CACHE_BYTES_LIMIT = '200M'
+
+def user_cache_dir():
+    """Return the per-user cache directory of this plugin"""
+    if sys.platform == 'win32':
+        base = os.environ.get('LOCALAPPDATA') or os.path.expanduser('~')
+    elif sys.platform == 'darwin':
+        base = os.path.expanduser('~/Library/Caches')
+    else:
+        base = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(base, 'ost-extender')
+
+def open_cache(name):
+    """Return a joblib.Memory in the user cache directory, or one that caches nothing if it can't be created"""
+    location = os.path.join(user_cache_dir(), name)
     try:
-        # Use chroma features for harmonic similarity
-        chroma = librosa.feature.chroma_cqt(y=y, sr=sr)
-        similarity_matrix = librosa.segment.recurrence_matrix(chroma, mode='affinity')
-        
-        # Find the most similar, non-adjacent segments
-        np.fill_diagonal(similarity_matrix, 0)
-        min_loop_frames = librosa.time_to_frames(min_duration, sr=sr)
-        for i in range(min_loop_frames):
-            np.fill_diagonal(similarity_matrix[i:, :], 0)
-            np.fill_diagonal(similarity_matrix[:, i:], 0)
-
-        frame2_coords, frame1_coords = np.unravel_index(np.argmax(similarity_matrix), similarity_matrix.shape)
-        frame1, frame2 = frame1_coords.item(), frame2_coords.item()
-        loop_start_frame, loop_end_frame = min(frame1, frame2), max(frame1, frame2)
-
-        # Snap to beats
-        beat_frames = librosa.beat.beat_track(y=y, sr=sr, units='frames')[1]
-        loop_start_frame_synced = beat_frames[np.argmin(np.abs(beat_frames - loop_start_frame))]
-        loop_end_frame_synced = beat_frames[np.argmin(np.abs(beat_frames - loop_end_frame))]
-
-        loop_start_time = librosa.frames_to_time(loop_start_frame_synced, sr=sr)
-        loop_end_time = librosa.frames_to_time(loop_end_frame_synced, sr=sr)
-        
-        return f"{loop_start_time}:{loop_end_time}"
-    except Exception as e:
-        return f"Error: {str(e)}"
+        os.makedirs(location, exist_ok=True)
+        return joblib.Memory(location, verbose=0)
+    except OSError:
+        return joblib.Memory(None, verbose=0)
+
+# Features are cached per user, keyed on the absolute file path, its
+# modification time and the analysis settings
+memory = open_cache('plugin')
+
+# Columns per block when scanning the self-similarity matrix
+BLOCK_SIZE = 256
+
+# Frame grid of the beat tracker, and of all frame <-> time conversions
+HOP_LENGTH = 512
+# Chroma is only compared per beat, so a coarser grid is enough
+CHROMA_HOP_LENGTH = 2048
+
+def frames_to_time(frames, sr):
+    """Convert frame indices on the HOP_LENGTH grid to seconds"""
+    return frames * HOP_LENGTH / sr
+
+def time_to_frames(seconds, sr):
+    """Convert seconds to a frame index on the HOP_LENGTH grid (rounded down, as librosa does)"""
+    return int(seconds * sr) // HOP_LENGTH
+
+def header_duration(file_path):
+    """Return the duration stored in the file header, or None if soundfile cannot read it"""
+    try:
+        return sf.info(file_path).duration
+    except RuntimeError:
+        return None
+
+@memory.cache
+def _compute_features(file_path, mtime, sr, duration, hop_length, chroma_hop_length):
+    y, sr = librosa.load(file_path, sr=sr, duration=duration)
+    # Chroma and beats are independent and mostly run in native code, so run them side by side
+    # with one BLAS thread each. STFT chroma is far cheaper than CQT and precise enough here
+    with threadpool_limits(limits=1), ThreadPoolExecutor(max_workers=2) as executor:
+        chroma_future = executor.submit(librosa.feature.chroma_stft, y=y, sr=sr, n_fft=2048,
+                                        hop_length=chroma_hop_length)
+        beats_future = executor.submit(librosa.beat.beat_track, y=y, sr=sr, hop_length=hop_length, units='frames')
+        chroma = chroma_future.result()
+        beat_frames = beats_future.result()[1]
+    # Only the length of the audio is needed later, so the audio itself isn't cached
+    return len(y) / sr, chroma, beat_frames
+
+def compute_features(file_path, sr=22050, duration=None):
+    """Load the track and return (duration, chroma, beat_frames), reusing cached results"""
+    features = _compute_features(os.path.abspath(file_path), os.path.getmtime(file_path), sr, duration,
+                                 HOP_LENGTH, CHROMA_HOP_LENGTH)
+    memory.reduce_size(bytes_limit=CACHE_BYTES_LIMIT)
+    return features
+
+@lru_cache(maxsize=4)
+def upper_triangle(n_rows, n_cols):
+    """Indices of the upper triangle of an n_rows x n_cols block, shared between block rows"""
+    return np.triu_indices(n_rows, m=n_cols)
+
+def best_pair(features, min_distance):
+    """Return (i, j, value) of the most similar columns with j - i >= min_distance, block by block"""
+    # Cosine similarity between columns, in single precision: plenty for
+    # 12-bin chroma and still served by BLAS (numpy has no float16 matmul kernel)
+    features = np.asarray(features, dtype=np.float32)
+    features = features / (np.linalg.norm(features, axis=0) + np.float32(1e-8))
+    n = features.shape[1]
+    best_i, best_j, best_value = 0, 0, -np.inf
+    for i0 in range(0, n - min_distance, BLOCK_SIZE):
+        i1 = min(i0 + BLOCK_SIZE, n)
+        # Only the first column block reaches the band; there (j - j0) >= (i - i0)
+        for j0 in range(i0 + min_distance, n, BLOCK_SIZE):
+            j1 = min(j0 + BLOCK_SIZE, n)
+            block = features[:, i0:i1].T @ features[:, j0:j1]
+            if j0 == i0 + min_distance:
+                # Read only the valid upper triangle instead of masking the rest
+                rows, cols = upper_triangle(*block.shape)
+                flat = np.argmax(block[rows, cols])
+                i, j = rows[flat], cols[flat]
+            else:
+                i, j = np.unravel_index(np.argmax(block), block.shape)
+            if block[i, j] > best_value:
+                best_i, best_j, best_value = i0 + i, j0 + j, block[i, j]
+    return int(best_i), int(best_j), best_value
+
+def find_loop_points(chroma, beat_frames, sr, min_duration=5.0):
+    """Find loop points and return start:end format; raises ValueError if there is no loop"""
+    # Map the beats onto the coarser chroma grid. Beats closer than one chroma hop
+    # land on the same chroma frame, and sync would merge them, so keep only the
+    # first of each and index into the surviving beats from here on
+    chroma_beats = np.minimum(beat_frames * HOP_LENGTH // CHROMA_HOP_LENGTH, chroma.shape[1])
+    chroma_beats, first_beats = np.unique(chroma_beats, return_index=True)
+    beat_frames = beat_frames[first_beats]
+    if len(beat_frames) < 2:
+        raise ValueError("Could not find a steady beat.")
+    # Use beat-synchronous chroma features for harmonic similarity;
+    # column b covers beat_frames[b] to beat_frames[b + 1]
+    chroma_sync = librosa.util.sync(chroma, chroma_beats, aggregate=np.median, pad=False)
+    assert chroma_sync.shape[1] == len(beat_frames) - 1
+    
+    # Find the most similar, non-adjacent segments
+    min_loop_frames = time_to_frames(min_duration, sr)
+    min_loop_beats = max(1, np.searchsorted(beat_frames, beat_frames[0] + min_loop_frames))
+    beat1, beat2, score = best_pair(chroma_sync, min_loop_beats)
+    if score == -np.inf:
+        raise ValueError("Could not find a confident loop.")
+
+    # The matches are already on beats
+    loop_start_frame_synced = beat_frames[beat1]
+    loop_end_frame_synced = beat_frames[beat2]
+
+    loop_start_time = frames_to_time(loop_start_frame_synced, sr)
+    loop_end_time = frames_to_time(loop_end_frame_synced, sr)
+    
+    return f"{loop_start_time}:{loop_end_time}"
 
 if __name__ == "__main__":
     if len(sys.argv) != 2:
-        print("Usage: python looper.py <audio_file>")
+        print("Usage: python looper.py <audio_file>", file=sys.stderr)
         sys.exit(1)
     
     file_path = sys.argv[1]
     if not os.path.exists(file_path):
-        print(f"Error: File not found: {file_path}")
+        print(f"Error: File not found: {file_path}", file=sys.stderr)
         sys.exit(1)
     
     try:
-        y, sr = librosa.load(file_path, sr=22050)
-        total_duration = librosa.get_duration(y=y, sr=sr)
+        # Reject short files from the header before paying for a full decode
+        duration = header_duration(file_path)
+        if duration is not None and duration < 20:
+            print("Error: Audio file too short for analysis", file=sys.stderr)
+            sys.exit(1)
+
+        sr = 22050
+        total_duration, chroma, beat_frames = compute_features(file_path, sr=sr, duration=300) # Up to 5 mins is enough to find a loop
         
         if total_duration < 20:
-            print("Error: Audio file too short for analysis")
+            print("Error: Audio file too short for analysis", file=sys.stderr)
             sys.exit(1)
             
         min_loop_duration = total_duration * 0.15
-        result = find_loop_points(y, sr, min_duration=min_loop_duration)
+        result = find_loop_points(chroma, beat_frames, sr, min_duration=min_loop_duration)
         print(result)
         
     except Exception as e:
-        print(f"Error: {str(e)}")
+        # Errors go to stderr, which the plugin reads when the exit code is non-zero
+        print(f"Error: {str(e)}", file=sys.stderr)
         sys.exit(1)
\ No newline at end of file
@@ -1,6 +1,12 @@
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from threadpoolctl import threadpool_limits
+import joblib
 import librosa
 import numpy as np
+import soundfile as sf
 import argparse
+import multiprocessing as mp
 import sys
 import os
 
@@ -9,72 +15,252 @@ import os
 if sys.platform == 'win32':
     os.environ['LIBROSA_AUDIOWRITE_BINARY'] = 'ffmpeg'
 
-def find_loop_points(y, sr, min_duration=15.0):
+# Largest size the feature cache may grow to before old entries are evicted
+CACHE_BYTES_LIMIT = '200M'
+
+def user_cache_dir():
+    """
+    Returns the per-user cache directory of OST Extender.
+    """
+    if sys.platform == 'win32':
+        base = os.environ.get('LOCALAPPDATA') or os.path.expanduser('~')
+    elif sys.platform == 'darwin':
+        base = os.path.expanduser('~/Library/Caches')
+    else:
+        base = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(base, 'ost-extender')
+
+def open_cache(name):
+    """
+    Returns a joblib.Memory in the user cache directory, or one that
+    caches nothing if that directory can't be created.
+    """
+    location = os.path.join(user_cache_dir(), name)
+    try:
+        os.makedirs(location, exist_ok=True)
+        return joblib.Memory(location, verbose=0)
+    except OSError:
+        return joblib.Memory(None, verbose=0)
+
+# Features are cached per user, keyed on the absolute file path, its
+# modification time and the analysis settings
+memory = open_cache('analyzer')
+
+# File extensions picked up by --dir, compared case-insensitively
+AUDIO_EXTENSIONS = (".mp3", ".wav", ".flac")
+
+# Columns per block when scanning the self-similarity matrix
+BLOCK_SIZE = 256
+
+# Frame grid of the beat tracker, and of all frame <-> time conversions
+HOP_LENGTH = 512
+# Chroma is only compared per beat, so a coarser grid is enough
+CHROMA_HOP_LENGTH = 2048
+
+def frames_to_time(frames, sr):
+    """
+    Converts frame indices on the HOP_LENGTH grid to seconds.
+    """
+    return frames * HOP_LENGTH / sr
+
+def time_to_frames(seconds, sr):
+    """
+    Converts seconds to a frame index on the HOP_LENGTH grid,
+    rounding down the same way librosa.time_to_frames does.
+    """
+    return int(seconds * sr) // HOP_LENGTH
+
+def header_duration(file_path):
+    """
+    Returns the duration stored in the file header without decoding the audio,
+    or None if soundfile cannot read this format.
+    """
+    try:
+        return sf.info(file_path).duration
+    except RuntimeError:
+        return None
+
+@memory.cache
+def _compute_features(file_path, mtime, sr, duration, hop_length, chroma_hop_length):
+    y, sr = librosa.load(file_path, sr=sr, duration=duration)
+    # Chroma and beat tracking are independent and spend most of their time in
+    # native code, so they run side by side, each limited to one BLAS thread.
+    # STFT chroma is far cheaper than CQT and precise enough for loop matching
+    with threadpool_limits(limits=1), ThreadPoolExecutor(max_workers=2) as executor:
+        chroma_future = executor.submit(librosa.feature.chroma_stft, y=y, sr=sr, n_fft=2048,
+                                        hop_length=chroma_hop_length)
+        beats_future = executor.submit(librosa.beat.beat_track, y=y, sr=sr, hop_length=hop_length, units='frames')
+        chroma = chroma_future.result()
+        tempo, beat_frames = beats_future.result()
+    # Only the length of the audio is needed later, so the audio itself isn't cached
+    return len(y) / sr, chroma, beat_frames
+
+def compute_features(file_path, sr=22050, duration=None):
+    """
+    Loads the track and computes its chroma features and beat frames.
+    Returns (duration, chroma, beat_frames), reusing the cached result when
+    the file has not changed since the last analysis.
+    """
+    features = _compute_features(os.path.abspath(file_path), os.path.getmtime(file_path), sr, duration,
+                                 HOP_LENGTH, CHROMA_HOP_LENGTH)
+    memory.reduce_size(bytes_limit=CACHE_BYTES_LIMIT)
+    return features
+
+@lru_cache(maxsize=4)
+def upper_triangle(n_rows, n_cols):
+    """
+    Returns the indices of the upper triangle of an n_rows x n_cols block.
+    Every full block row has the same shape, so the arrays are built once.
+    """
+    return np.triu_indices(n_rows, m=n_cols)
+
+def best_pair(features, min_distance):
+    """
+    Returns (i, j, value) of the two most similar feature columns with
+    j - i >= min_distance. The cosine similarity is computed in blocks that
+    skip the band around the diagonal, so the full matrix is never stored.
+    value is -inf when no pair is far enough apart.
+    """
+    # Cosine similarity between columns, in single precision: plenty for
+    # 12-bin chroma and still served by BLAS (numpy has no float16 matmul kernel)
+    features = np.asarray(features, dtype=np.float32)
+    features = features / (np.linalg.norm(features, axis=0) + np.float32(1e-8))
+    n = features.shape[1]
+    best_i, best_j, best_value = 0, 0, -np.inf
+    for i0 in range(0, n - min_distance, BLOCK_SIZE):
+        i1 = min(i0 + BLOCK_SIZE, n)
+        # Only the first column block reaches the band; there (j - j0) >= (i - i0)
+        for j0 in range(i0 + min_distance, n, BLOCK_SIZE):
+            j1 = min(j0 + BLOCK_SIZE, n)
+            block = features[:, i0:i1].T @ features[:, j0:j1]
+            if j0 == i0 + min_distance:
+                # Read only the valid upper triangle instead of masking the rest
+                rows, cols = upper_triangle(*block.shape)
+                flat = np.argmax(block[rows, cols])
+                i, j = rows[flat], cols[flat]
+            else:
+                i, j = np.unravel_index(np.argmax(block), block.shape)
+            if block[i, j] > best_value:
+                best_i, best_j, best_value = i0 + i, j0 + j, block[i, j]
+    return int(best_i), int(best_j), best_value
+
+def find_loop_points(chroma, beat_frames, sr, min_duration=15.0):
     """
     Finds loop points by locating the two most similar, non-adjacent sections
     and defining the loop as the segment between them.
     """
-    # 1. Use chroma features for harmonic similarity
-    chroma = librosa.feature.chroma_cqt(y=y, sr=sr)
-    
-    # 2. Compute the self-similarity matrix
-    similarity_matrix = librosa.segment.recurrence_matrix(chroma, mode='affinity', sparse=True)
+    # Map the beats onto the coarser chroma grid. Beats closer than one chroma hop
+    # land on the same chroma frame, and sync would merge them, so keep only the
+    # first of each and index into the surviving beats from here on
+    chroma_beats = np.minimum(beat_frames * HOP_LENGTH // CHROMA_HOP_LENGTH, chroma.shape[1])
+    chroma_beats, first_beats = np.unique(chroma_beats, return_index=True)
+    beat_frames = beat_frames[first_beats]
+    if len(beat_frames) < 2:
+        raise ValueError("Could not find a steady beat.")
+
+    # 1. Use beat-synchronous chroma features (see compute_features) for harmonic
+    # similarity, which keeps the loop points musical and the matrix small.
+    # Column b covers beat_frames[b] to beat_frames[b + 1]
+    chroma_sync = librosa.util.sync(chroma, chroma_beats, aggregate=np.median, pad=False)
+    assert chroma_sync.shape[1] == len(beat_frames) - 1
+
+    # 2. Work out how many beats apart the two sections must be.
+    # The main diagonal and the band close to it would only give trivial loops
+    min_loop_frames = time_to_frames(min_duration, sr)
+    min_loop_beats = max(1, np.searchsorted(beat_frames, beat_frames[0] + min_loop_frames))
+
+    # 3. Find the brightest point of the self-similarity matrix (one row per beat)
+    # outside that band. best_pair computes the matrix block by block and never
+    # builds the band or the lower triangle
+    beat1_coords, beat2_coords, score = best_pair(chroma_sync, min_loop_beats)
+    if score == -np.inf:
+        raise ValueError("Could not find a confident loop.")
+
+    # 4. The matches are beat indices, so they map straight back to beat frames
+    # and the start and end can never land on the same beat
+    loop_start_frame_synced = beat_frames[beat1_coords]
+    loop_end_frame_synced = beat_frames[beat2_coords]
+
+    # 5. Convert the beat-synced frames back to time (seconds)
+    loop_start_time = frames_to_time(loop_start_frame_synced, sr)
+    loop_end_time = frames_to_time(loop_end_frame_synced, sr)
     
-    # 3. Find the most similar, non-adjacent segments
-    # Zero out the main diagonal and areas close to it to avoid trivial loops
-    min_loop_frames = librosa.time_to_frames(min_duration, sr=sr)
-    similarity_matrix = similarity_matrix.toarray()
-    np.fill_diagonal(similarity_matrix, 0)
-    for i in range(min_loop_frames):
-        np.fill_diagonal(similarity_matrix[i:, :], 0)
-        np.fill_diagonal(similarity_matrix[:, i:], 0)
-
-    # 4. Find the coordinates of the brightest point in the matrix
-    frame2_coords, frame1_coords = np.unravel_index(np.argmax(similarity_matrix), similarity_matrix.shape)
-    frame1, frame2 = min(frame1_coords, frame2_coords), max(frame1_coords, frame2_coords)
-
-    # 5. Snap these points to the nearest beat for musicality
-    tempo, beat_frames = librosa.beat.beat_track(y=y, sr=sr, units='frames')
+    return {"loop_start": loop_start_time, "loop_end": loop_end_time}
+
+def analyze_track(track_path):
+    """
+    Runs the whole analysis on one file and returns its loop points.
+    Raises ValueError when the track is too short or has no confident loop.
+    """
+    # Reject short files from the header before paying for a full decode
+    duration = header_duration(track_path)
+    if duration is not None and duration < 20:
+        raise ValueError("Audio file is too short for meaningful loop analysis.")
+
+    sr = 22050
+    total_duration, chroma, beat_frames = compute_features(track_path, sr=sr, duration=300) # Load up to 5 mins for faster analysis
     
-    # Find the beat closest to our calculated start and end frames
-    loop_start_frame_synced = beat_frames[np.argmin(np.abs(beat_frames - frame1))]
-    loop_end_frame_synced = beat_frames[np.argmin(np.abs(beat_frames - frame2))]
+    if total_duration < 20:
+        raise ValueError("Audio file is too short for meaningful loop analysis.")
+        
+    # Set a minimum loop duration of 15% of the track length or 15 seconds, whichever is larger
+    min_loop_duration = max(15.0, total_duration * 0.15)
     
-    # Ensure start and end are not the same beat
-    if loop_start_frame_synced == loop_end_frame_synced:
-        raise ValueError("Loop points are too close to sync to the beat.")
+    loop_points = find_loop_points(chroma, beat_frames, sr, min_duration=min_loop_duration)
+    if not loop_points or loop_points['loop_end'] <= loop_points['loop_start']:
+        raise ValueError("Could not find a confident loop.")
+    return loop_points
 
-    # 6. Convert the beat-synced frames back to time (seconds)
-    loop_start_time = librosa.frames_to_time(loop_start_frame_synced, sr=sr)
-    loop_end_time = librosa.frames_to_time(loop_end_frame_synced, sr=sr)
-    
-    return {"loop_start": loop_start_time, "loop_end": loop_end_time}
+def analyze_batch_track(track_path):
+    """
+    Pool worker for --dir: returns (found, line) where line is "path<TAB>start:end",
+    or "path<TAB>Error: ..." so that one bad file doesn't stop the batch.
+    """
+    try:
+        loop_points = analyze_track(track_path)
+        return True, f"{track_path}\t{loop_points['loop_start']}:{loop_points['loop_end']}"
+    except Exception as e:
+        return False, f"{track_path}\tError: {e}"
+
+def limit_worker_threads():
+    """Pool initializer: one BLAS thread per worker process, the pool provides the parallelism"""
+    global _worker_thread_limits
+    _worker_thread_limits = threadpool_limits(limits=1)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Find loop points in an audio track.")
-    parser.add_argument("track_path", type=str, help="The path to the audio file.")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("track_path", type=str, nargs="?", help="The path to the audio file.")
+    source.add_argument("--dir", type=str, help="Analyze every mp3, wav and flac file in this directory.")
     args = parser.parse_args()
 
+    if args.dir:
+        if not os.path.isdir(args.dir):
+            parser.error(f"--dir: not a directory: {args.dir}")
+        # Listed rather than globbed, so folder names like "Game [OST]" are taken literally
+        track_paths = sorted(entry.path for entry in os.scandir(args.dir)
+                             if entry.is_file() and os.path.splitext(entry.name)[1].lower() in AUDIO_EXTENSIONS)
+        if not track_paths:
+            print(f"Error: No mp3, wav or flac files found in {args.dir}", file=sys.stderr)
+            sys.exit(1)
+
+        # At most one process per core and never more than there are files, so the
+        # library imports are paid once per worker rather than once per file
+        n_workers = min(os.cpu_count() or 1, len(track_paths))
+        all_found = True
+        with mp.Pool(n_workers, initializer=limit_worker_threads) as pool:
+            for found, line in pool.imap(analyze_batch_track, track_paths):
+                print(line, flush=True)
+                all_found = all_found and found
+        sys.exit(0 if all_found else 1)
+
     try:
-        y, sr = librosa.load(args.track_path, sr=22050, duration=300) # Load up to 5 mins for faster analysis
-        
-        total_duration = librosa.get_duration(y=y, sr=sr)
-        if total_duration < 20:
-            raise ValueError("Audio file is too short for meaningful loop analysis.")
-            
-        # Set a minimum loop duration of 15% of the track length or 15 seconds, whichever is larger
-        min_loop_duration = max(15.0, total_duration * 0.15)
-        
-        loop_points = find_loop_points(y, sr, min_duration=min_loop_duration)
-        
-        if loop_points and loop_points['loop_end'] > loop_points['loop_start']:
-            # Print the result in a simple, parseable format: start_time:end_time
-            print(f"{loop_points['loop_start']}:{loop_points['loop_end']}")
-            sys.exit(0) # Success
-        else:
-            raise ValueError("Could not find a confident loop.")
+        loop_points = analyze_track(args.track_path)
+        # Print the result in a simple, parseable format: start_time:end_time
+        print(f"{loop_points['loop_start']}:{loop_points['loop_end']}")
+        sys.exit(0) # Success
 
     except Exception as e:
         # Print any errors to the standard error stream for C# to catch
         print(f"Error: {e}", file=sys.stderr)
-        sys.exit(1) # Failure
\ No newline at end of file
+        sys.exit(1) # Failure
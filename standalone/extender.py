@@ -1,69 +1,205 @@
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from threadpoolctl import threadpool_limits
+import joblib
 import librosa
 import numpy as np
 import argparse
 import soundfile as sf
+import sys
 import os
 
-def find_loop_points(y, sr, min_duration=5.0):
+# Largest size the feature cache may grow to before old entries are evicted
+CACHE_BYTES_LIMIT = '200M'
+
+def user_cache_dir():
+    """
+    Returns the per-user cache directory of OST Extender.
+    """
+    if sys.platform == 'win32':
+        base = os.environ.get('LOCALAPPDATA') or os.path.expanduser('~')
+    elif sys.platform == 'darwin':
+        base = os.path.expanduser('~/Library/Caches')
+    else:
+        base = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(base, 'ost-extender')
+
+def open_cache(name):
+    """
+    Returns a joblib.Memory in the user cache directory, or one that
+    caches nothing if that directory can't be created.
+    """
+    location = os.path.join(user_cache_dir(), name)
+    try:
+        os.makedirs(location, exist_ok=True)
+        return joblib.Memory(location, verbose=0)
+    except OSError:
+        return joblib.Memory(None, verbose=0)
+
+# Features are cached per user, keyed on the absolute file path, its
+# modification time and the analysis settings
+memory = open_cache('extender')
+
+# Columns per block when scanning the self-similarity matrix
+BLOCK_SIZE = 256
+
+# Frame grid of the beat tracker, and of all frame <-> time conversions
+HOP_LENGTH = 512
+# Chroma is only compared per beat, so a coarser grid is enough
+CHROMA_HOP_LENGTH = 2048
+
+def frames_to_time(frames, sr):
+    """
+    Converts frame indices on the HOP_LENGTH grid to seconds.
+    """
+    return frames * HOP_LENGTH / sr
+
+def time_to_frames(seconds, sr):
+    """
+    Converts seconds to a frame index on the HOP_LENGTH grid,
+    rounding down the same way librosa.time_to_frames does.
+    """
+    return int(seconds * sr) // HOP_LENGTH
+
+def header_duration(file_path):
+    """
+    Returns the duration stored in the file header without decoding the audio,
+    or None if soundfile cannot read this format.
+    """
+    try:
+        return sf.info(file_path).duration
+    except RuntimeError:
+        return None
+
+@memory.cache(ignore=['y'])
+def _compute_features(file_path, mtime, sr, duration, hop_length, chroma_hop_length, y):
+    # Use chroma features for harmonic similarity; STFT chroma is far
+    # cheaper than CQT and precise enough for loop matching.
+    # Both steps are independent and spend most of their time in native code,
+    # so they run side by side, each limited to one BLAS thread
+    with threadpool_limits(limits=1), ThreadPoolExecutor(max_workers=2) as executor:
+        chroma_future = executor.submit(librosa.feature.chroma_stft, y=y, sr=sr, n_fft=2048,
+                                        hop_length=chroma_hop_length)
+        beats_future = executor.submit(librosa.beat.beat_track, y=y, sr=sr, hop_length=hop_length, units='frames')
+        chroma = chroma_future.result()
+        beat_frames = beats_future.result()[1]
+    return chroma, beat_frames
+
+def load_track(file_path, sr=22050, duration=None):
+    """
+    Decodes the track once at its native sample rate, for the extended file,
+    and downsamples it in memory for the analysis.
+    Returns (y_orig, sr_orig, y), where y is the audio at sr.
+    """
+    y_orig, sr_orig = librosa.load(file_path, sr=None, duration=duration)
+    y = librosa.resample(y_orig, orig_sr=sr_orig, target_sr=sr)
+    return y_orig, sr_orig, y
+
+def compute_features(file_path, y, sr=22050, duration=None):
+    """
+    Computes the chroma features and beat frames of y, the first duration
+    seconds of file_path loaded at sr. Returns (chroma, beat_frames), reusing
+    the cached result when the file has not changed since the last run.
+    Only the features are cached; the audio is not part of the cache key.
+    """
+    features = _compute_features(os.path.abspath(file_path), os.path.getmtime(file_path), sr, duration,
+                                 HOP_LENGTH, CHROMA_HOP_LENGTH, y)
+    memory.reduce_size(bytes_limit=CACHE_BYTES_LIMIT)
+    return features
+
+@lru_cache(maxsize=4)
+def upper_triangle(n_rows, n_cols):
+    """
+    Returns the indices of the upper triangle of an n_rows x n_cols block.
+    Every full block row has the same shape, so the arrays are built once.
+    """
+    return np.triu_indices(n_rows, m=n_cols)
+
+def best_pair(features, min_distance):
+    """
+    Returns (i, j, value) of the two most similar feature columns with
+    j - i >= min_distance. The cosine similarity is computed in blocks that
+    skip the band around the diagonal, so the full matrix is never stored.
+    value is -inf when no pair is far enough apart.
+    """
+    # Cosine similarity between columns, in single precision: plenty for
+    # 12-bin chroma and still served by BLAS (numpy has no float16 matmul kernel)
+    features = np.asarray(features, dtype=np.float32)
+    features = features / (np.linalg.norm(features, axis=0) + np.float32(1e-8))
+    n = features.shape[1]
+    best_i, best_j, best_value = 0, 0, -np.inf
+    for i0 in range(0, n - min_distance, BLOCK_SIZE):
+        i1 = min(i0 + BLOCK_SIZE, n)
+        # Only the first column block reaches the band; there (j - j0) >= (i - i0)
+        for j0 in range(i0 + min_distance, n, BLOCK_SIZE):
+            j1 = min(j0 + BLOCK_SIZE, n)
+            block = features[:, i0:i1].T @ features[:, j0:j1]
+            if j0 == i0 + min_distance:
+                # Read only the valid upper triangle instead of masking the rest
+                rows, cols = upper_triangle(*block.shape)
+                flat = np.argmax(block[rows, cols])
+                i, j = rows[flat], cols[flat]
+            else:
+                i, j = np.unravel_index(np.argmax(block), block.shape)
+            if block[i, j] > best_value:
+                best_i, best_j, best_value = i0 + i, j0 + j, block[i, j]
+    return int(best_i), int(best_j), best_value
+
+def find_loop_points(chroma, beat_frames, sr, min_duration=5.0):
     """
     Finds loop points by finding the two most similar, non-adjacent sections
     and defining the loop as the segment between them.
     """
-    print("Analyzing harmony...")
-    # Use chroma features for harmonic similarity
-    chroma = librosa.feature.chroma_cqt(y=y, sr=sr)
-    # Compute the self-similarity matrix
-    similarity_matrix = librosa.segment.recurrence_matrix(chroma, mode='affinity')
+    # Map the beats onto the coarser chroma grid. Beats closer than one chroma hop
+    # land on the same chroma frame, and sync would merge them, so keep only the
+    # first of each and index into the surviving beats from here on
+    chroma_beats = np.minimum(beat_frames * HOP_LENGTH // CHROMA_HOP_LENGTH, chroma.shape[1])
+    chroma_beats, first_beats = np.unique(chroma_beats, return_index=True)
+    beat_frames = beat_frames[first_beats]
+    if len(beat_frames) < 2:
+        raise ValueError("Could not find a steady beat in the track.")
+    # Aggregate the chroma over each beat so the matrix has one row per beat;
+    # column b covers beat_frames[b] to beat_frames[b + 1]
+    chroma_sync = librosa.util.sync(chroma, chroma_beats, aggregate=np.median, pad=False)
+    assert chroma_sync.shape[1] == len(beat_frames) - 1
     
     # Find the most similar, non-adjacent segments
-    np.fill_diagonal(similarity_matrix, 0)
-    min_loop_frames = librosa.time_to_frames(min_duration, sr=sr)
-    for i in range(min_loop_frames):
-        np.fill_diagonal(similarity_matrix[i:, :], 0)
-        np.fill_diagonal(similarity_matrix[:, i:], 0)
-
-    # Find the coordinates of the brightest point in the matrix
-    frame2_coords, frame1_coords = np.unravel_index(np.argmax(similarity_matrix), similarity_matrix.shape)
-    frame1, frame2 = frame1_coords.item(), frame2_coords.item()
-    loop_start_frame, loop_end_frame = min(frame1, frame2), max(frame1, frame2)
-
-    print("Finding the beat and snapping points...")
-    # Snap these points to the nearest beat for musicality
-    beat_frames = librosa.beat.beat_track(y=y, sr=sr, units='frames')[1]
-    loop_start_frame_synced = beat_frames[np.argmin(np.abs(beat_frames - loop_start_frame))]
-    loop_end_frame_synced = beat_frames[np.argmin(np.abs(beat_frames - loop_end_frame))]
+    min_loop_frames = time_to_frames(min_duration, sr)
+    min_loop_beats = max(1, np.searchsorted(beat_frames, beat_frames[0] + min_loop_frames))
+
+    # Find the brightest point of the self-similarity matrix, skipping the diagonal band
+    beat1, beat2, score = best_pair(chroma_sync, min_loop_beats)
+    if score == -np.inf:
+        raise ValueError("Could not find a confident loop in the track.")
+
+    # The matches are beat indices, so they map straight back to beat frames
+    loop_start_frame_synced = beat_frames[beat1]
+    loop_end_frame_synced = beat_frames[beat2]
 
     # Convert the beat-synced frames back to time (seconds)
-    loop_start_time = librosa.frames_to_time(loop_start_frame_synced, sr=sr)
-    loop_end_time = librosa.frames_to_time(loop_end_frame_synced, sr=sr)
+    loop_start_time = frames_to_time(loop_start_frame_synced, sr)
+    loop_end_time = frames_to_time(loop_end_frame_synced, sr)
     
     return {"loop_start": loop_start_time, "loop_end": loop_end_time}
 
-def extend_track(file_path, loop_start, loop_end, target_duration_seconds):
+def extend_track(y, sr, loop_start, loop_end, target_duration_seconds, output_path):
     """
-    Creates a new audio file with the B part looped to reach the target duration.
+    Writes the already decoded audio to output_path with the B part looped
+    to reach the target duration.
     """
     print(f"Extending track to {target_duration_seconds} seconds...")
-    y, sr = librosa.load(file_path, sr=None)
     
-    loop_start_samples = librosa.time_to_samples(loop_start, sr=sr)
-    loop_end_samples = librosa.time_to_samples(loop_end, sr=sr)
+    loop_start_samples = int(loop_start * sr)
+    loop_end_samples = int(loop_end * sr)
 
     intro_and_first_loop = y[:loop_end_samples]
     loop_segment = y[loop_start_samples:loop_end_samples]
     
-    extended_audio = list(intro_and_first_loop)
-    current_duration = librosa.get_duration(y=np.array(extended_audio), sr=sr)
-
-    while current_duration < target_duration_seconds:
-        extended_audio.extend(loop_segment)
-        current_duration = librosa.get_duration(y=np.array(extended_audio), sr=sr)
-        
-    final_audio = np.array(extended_audio)
-    
-    # Create the output filename
-    base_name, ext = os.path.splitext(file_path)
-    output_path = f"{base_name}_extended.wav"
+    # Work out up front how many extra loops reach the target, then build
+    # the output in one allocation instead of growing it loop by loop
+    target_samples = int(np.ceil(target_duration_seconds * sr))
+    n_loops_needed = max(0, int(np.ceil((target_samples - len(intro_and_first_loop)) / len(loop_segment))))
+    final_audio = np.concatenate([intro_and_first_loop, np.tile(loop_segment, n_loops_needed)])
     
     print(f"Saving extended file to: {output_path}")
     sf.write(output_path, final_audio, sr)
@@ -78,23 +214,36 @@ if __name__ == "__main__":
     args = parser.parse_args()
 
     try:
+        # Reject short files from the header before paying for a full decode
+        duration = header_duration(args.track_path)
+        if duration is not None and duration < 20:
+            raise ValueError("Audio file is too short for loop analysis.")
+
         print(f"Loading track: {args.track_path}")
         # Load the audio data for analysis
-        y, sr = librosa.load(args.track_path, sr=22050) # Downsample for faster analysis
+        sr = 22050 # Downsample for faster analysis
+        # Up to 5 mins is enough to find a loop, and the loop always ends inside it
+        y_orig, sr_orig, y = load_track(args.track_path, sr=sr, duration=300)
         
-        total_duration = librosa.get_duration(y=y, sr=sr)
+        total_duration = len(y) / sr
         if total_duration < 20:
             raise ValueError("Audio file is too short for loop analysis.")
+
+        print("Analyzing harmony and finding the beat...")
+        chroma, beat_frames = compute_features(args.track_path, y, sr=sr, duration=300)
             
         min_loop_duration = total_duration * 0.15
         
         # Find the loop points
-        loop_points = find_loop_points(y, sr, min_duration=min_loop_duration)
+        loop_points = find_loop_points(chroma, beat_frames, sr, min_duration=min_loop_duration)
         
         if loop_points:
             print(f"Loop found! Start: {loop_points['loop_start']:.2f}s, End: {loop_points['loop_end']:.2f}s")
             # Extend the track using the original, full-quality audio
-            extend_track(args.track_path, loop_points['loop_start'], loop_points['loop_end'], args.duration)
+            base_name, ext = os.path.splitext(args.track_path)
+            output_path = f"{base_name}_extended.wav"
+            extend_track(y_orig, sr_orig, loop_points['loop_start'], loop_points['loop_end'],
+                         args.duration, output_path)
         else:
             print("Could not find a confident loop in the track.")
 